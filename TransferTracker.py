@@ -1,8 +1,21 @@
 import streamlit as st
 import pandas as pd
 import os
+import io
+import glob
+import sys
+import tempfile
+from collections import deque
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
+from openpyxl import load_workbook
+
+# Prefer the Rust-based calamine reader, fall back to openpyxl if it's not installed
+try:
+    import python_calamine  # noqa: F401
+    excel_engine = "calamine"
+except ImportError:
+    excel_engine = "openpyxl"
 
 # ---------- Setup ----------
 st.set_page_config(page_title="Stock Transfer Tracker", page_icon="🚚", layout="wide")
@@ -15,107 +28,246 @@ os.makedirs(data_folder, exist_ok=True)
 # File paths
 stock_on_hand_file = os.path.join(data_folder, "book1.xlsx")
 catalogue_file = os.path.join(data_folder, "CATALOGUE.xlsx")
-transfers_file = os.path.join(data_folder, "stock_transfers.xlsx")
+transfers_file = os.path.join(data_folder, "stock_transfers.csv")
+legacy_transfers_file = os.path.join(data_folder, "stock_transfers.xlsx")
+
+# Columns written to the transfers file
+transfer_columns = [
+    "Date", "Time", "Item No", "Item Description",
+    "Quantity", "From Location", "To Location", "Notes",
+]
+
+# Fields held for each transfer row being filled in
+transfer_row_columns = ["item_selected", "quantity", "from_location", "to_location", "notes"]
+
+# Cap on unsubmitted rows per session, so a long-open tab can't grow without bound
+max_transfer_rows = 200
 
 # Define local timezone
-local_timezone = pytz.timezone('Australia/Sydney')
+local_timezone = ZoneInfo('Australia/Sydney')
 
 # ---------- Functions ----------
 
-def load_locations():
-    if not os.path.exists(stock_on_hand_file):
-        st.error(f"Stock on hand file '{stock_on_hand_file}' not found.")
+def file_mtime(path, label):
+    if not os.path.exists(path):
+        st.error(f"{label} file '{path}' not found.")
         st.stop()
-    df = pd.read_excel(stock_on_hand_file)
-    if "Bin Location Description" not in df.columns:
+    return os.path.getmtime(path)
+
+# mtime is passed in so the cache is invalidated whenever the file changes.
+# cache_resource hands every rerun the same interned tuples rather than unpickled
+# copies, so the option lists passed to the selectboxes are shared.
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_locations(mtime):
+    if excel_engine == "calamine":
+        df = pd.read_excel(
+            stock_on_hand_file,
+            usecols=lambda c: c == "Bin Location Description",
+            engine=excel_engine,
+        )
+        if "Bin Location Description" in df.columns:
+            locations = df["Bin Location Description"].dropna().drop_duplicates().sort_values().tolist()
+        else:
+            locations = None
+    else:
+        locations = stream_locations()
+    if locations is None:
         st.error("'Bin Location Description' column not found in book1.xlsx.")
         st.stop()
-    locations = sorted(df["Bin Location Description"].dropna().unique().tolist())
-    return locations
-
-def load_parts():
-    if not os.path.exists(catalogue_file):
-        st.error(f"Catalogue file '{catalogue_file}' not found.")
-        st.stop()
-    df = pd.read_excel(catalogue_file)
-    if "ItemCode" not in df.columns or "ItemName" not in df.columns:
-        st.error("'ItemCode' or 'ItemName' column not found in CATALOGUE.xlsx.")
-        st.stop()
-    df["Combined"] = df["ItemCode"].astype(str) + " - " + df["ItemName"].astype(str)
-    return df
-
-def add_row(prev_from=None, prev_to=None):
+    return tuple(sys.intern(str(loc)) for loc in locations)
+
+def stream_locations():
+    # Without calamine, stream just the one column in read-only mode instead of building a DataFrame
+    wb = load_workbook(stock_on_hand_file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]  # same sheet pd.read_excel reads
+        header = next(ws.iter_rows(max_row=1, values_only=True), ())
+        if "Bin Location Description" not in header:
+            return None
+        col = header.index("Bin Location Description") + 1
+        locations = {
+            value for (value,) in ws.iter_rows(min_row=2, min_col=col, max_col=col, values_only=True)
+            if value is not None
+        }
+    finally:
+        wb.close()
+    return sorted(locations)
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_parts(mtime):
+    df = read_catalogue_cache()
+    if df is None:
+        df = pd.read_excel(
+            catalogue_file,
+            usecols=lambda c: c in ("ItemCode", "ItemName"),
+            engine=excel_engine,
+        )
+        if "ItemCode" not in df.columns or "ItemName" not in df.columns:
+            st.error("'ItemCode' or 'ItemName' column not found in CATALOGUE.xlsx.")
+            st.stop()
+        # Blank out missing codes/names; on pandas 3 astype(str) keeps NaN, and a
+        # NaN label can't be interned and would hide the rest of the name
+        df = pd.DataFrame({
+            "Combined": df["ItemCode"].fillna("").astype(str) + " - " + df["ItemName"].fillna("").astype(str)
+        })
+        write_catalogue_cache(df)
+    return tuple(sys.intern(part) for part in df["Combined"])
+
+def catalogue_cache_path():
+    # The cache is named after the XLSX's exact mtime and size, so any replacement
+    # catalogue misses it, even one copied in with an older mtime
+    stat = os.stat(catalogue_file)
+    return os.path.join(data_folder, f"catalogue.{stat.st_mtime_ns}.{stat.st_size}.parquet")
+
+def read_catalogue_cache():
+    cache_file = catalogue_cache_path()
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        return pd.read_parquet(cache_file)
+    except Exception:
+        return None
+
+def write_catalogue_cache(df):
+    # The cache is only an optimisation, so skip it if parquet support is missing
+    cache_file = catalogue_cache_path()
+    try:
+        df.to_parquet(cache_file, index=False)
+    except Exception:
+        return
+    # Remove caches built from earlier versions of the catalogue
+    for old_file in glob.glob(os.path.join(data_folder, "catalogue*.parquet")):
+        if old_file != cache_file:
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass
+
+def add_row():
     new_row = {
-        "item_selected": "",
+        "item_selected": None,
         "quantity": 0,
-        "from_location": prev_from if prev_from else locations_list[0],
-        "to_location": prev_to if prev_to else locations_list[0],
+        "from_location": default_location,
+        "to_location": default_location,
         "notes": "",  # New field
     }
     st.session_state.transfer_rows.append(new_row)
 
-def delete_row(idx):
-    if 0 <= idx < len(st.session_state.transfer_rows):
-        st.session_state.transfer_rows.pop(idx)
-
 def save_transfers(rows):
+    # Returns True if any transfers were saved
     if not rows:
-        return
+        return False
 
     now = datetime.now(local_timezone)
+    date_s = now.strftime("%Y-%m-%d")
+    time_s = now.strftime("%H:%M:%S")
 
-    records = []
-    for row in rows:
-        selected_text = row["item_selected"]
-        quantity = row["quantity"]
-
-        # Only save rows where item is selected and quantity > 0
-        if selected_text and quantity > 0:
-            if " - " in selected_text:
-                item_code, item_name = selected_text.split(" - ", 1)
-            else:
-                item_code, item_name = selected_text, ""
-
-            records.append({
-                "Date": now.strftime("%Y-%m-%d"),
-                "Time": now.strftime("%H:%M:%S"),
-                "Item No": item_code,
-                "Item Description": item_name,
-                "Quantity": quantity,
-                "From Location": row["from_location"],
-                "To Location": row["to_location"],
-                "Notes": row.get("notes", ""),
-            })
-
-    if not records:
-        st.warning("⚠️ No valid transfers to save.")
-        return
+    df = pd.DataFrame(rows)
+    if "notes" not in df.columns:
+        df["notes"] = ""
 
-    new_df = pd.DataFrame(records)
+    # Only save rows where item is selected and quantity > 0
+    df = df[(df["item_selected"] != "") & (df["quantity"] > 0)]
 
-    if os.path.exists(transfers_file):
-        existing_df = pd.read_excel(transfers_file)
-        combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-    else:
-        combined_df = new_df
+    if df.empty:
+        st.warning("⚠️ No valid transfers to save.")
+        return False
 
-    combined_df.to_excel(transfers_file, index=False)
+    split = df["item_selected"].str.split(" - ", n=1, expand=True).reindex(columns=[0, 1])
+    new_df = pd.DataFrame({
+        "Date": date_s,
+        "Time": time_s,
+        "Item No": split[0],
+        "Item Description": split[1].fillna(""),
+        "Quantity": df["quantity"],
+        "From Location": df["from_location"],
+        "To Location": df["to_location"],
+        "Notes": df["notes"].fillna(""),
+    }, columns=transfer_columns)
+
+    append_transfers(new_df)
+    return True
+
+def append_transfers(df):
+    if not os.path.exists(transfers_file) and create_transfers_file(df):
+        return
 
-def last_row_has_item_selected():
-    if not st.session_state.transfer_rows:
+    # Otherwise append the rows with one write() on an O_APPEND fd, so rows from
+    # concurrent sessions land one after another rather than interleaved
+    data = transfers_csv(df, header=False)
+    fd = os.open(transfers_file, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def create_transfers_file(df):
+    # Write header + rows to a private temp file and hard-link it into place, so the
+    # file only ever appears complete and only one session can create it.
+    # Returns False if the file already existed.
+    data = transfers_csv(df, header=True)
+    fd, tmp_file = tempfile.mkstemp(dir=data_folder, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.link(tmp_file, transfers_file)
+        return True
+    except FileExistsError:
+        return False
+    except OSError:
+        # No hard links on this filesystem (FAT/exFAT, some network mounts)
+        return create_transfers_file_exclusive(data)
+    finally:
+        os.remove(tmp_file)
+
+def create_transfers_file_exclusive(data):
+    # Exclusive create still stops two sessions both creating the file, though
+    # another session may briefly see it before the rows are written
+    try:
+        fd = os.open(transfers_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
         return False
-    last_row = st.session_state.transfer_rows[-1]
-    return last_row["item_selected"] != ""
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    return True
+
+def transfers_csv(df, header):
+    # Newlines in values are flattened to spaces so each record is one line
+    df = df.replace(r"[\r\n]+", " ", regex=True)
+    return df.to_csv(index=False, header=header).encode("utf-8")
+
+def import_legacy_transfers():
+    # One-time copy of the history kept in stock_transfers.xlsx before the switch to CSV
+    if os.path.exists(transfers_file) or not os.path.exists(legacy_transfers_file):
+        return
+    # Read everything as text so codes like "00123" are copied unchanged
+    df = pd.read_excel(legacy_transfers_file, dtype=str, engine=excel_engine)
+    create_transfers_file(df.reindex(columns=transfer_columns))
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_recent_transfers(file_version, n=10):
+    # Only keep the header and the last n lines rather than parsing the whole history.
+    # This relies on every record being on one line, see transfers_csv().
+    with open(transfers_file, newline="", encoding="utf-8") as f:
+        header = f.readline()
+        last = deque(f, maxlen=n)
+    return pd.read_csv(io.StringIO(header + "".join(last)))
 
 # ---------- Load Data ----------
 
-locations_list = load_locations()
-parts_df = load_parts()
-all_parts = parts_df["Combined"].tolist()
+import_legacy_transfers()
+
+locations_list = load_locations(file_mtime(stock_on_hand_file, "Stock on hand"))
+default_location = locations_list[0]
+all_parts = load_parts(file_mtime(catalogue_file, "Catalogue"))
 
 # ---------- Session State ----------
 if "transfer_rows" not in st.session_state:
     st.session_state.transfer_rows = []
+if "editor_version" not in st.session_state:
+    st.session_state.editor_version = 0
 
 # Ensure all old rows have 'notes' field
 for row in st.session_state.transfer_rows:
@@ -130,75 +282,67 @@ if len(st.session_state.transfer_rows) == 0:
 
 st.markdown("### Fill Stock Transfers:")
 
-rows_to_delete = []
-
-# Display transfer rows
-for idx, row in enumerate(st.session_state.transfer_rows):
-    st.markdown(f"**Transfer {idx+1}**")
-
-    cols = st.columns([2, 2, 5, 1, 3])  # To | From | Item | Qty | Notes
-
-    with cols[0]:
-        to_loc = st.selectbox(
-            "To", options=locations_list,
-            index=locations_list.index(row["to_location"]) if row["to_location"] in locations_list else 0,
-            key=f"to_{idx}",
-        )
-        st.session_state.transfer_rows[idx]["to_location"] = to_loc
-
-    with cols[1]:
-        from_loc = st.selectbox(
-            "From", options=locations_list,
-            index=locations_list.index(row["from_location"]) if row["from_location"] in locations_list else 0,
-            key=f"from_{idx}",
-        )
-        st.session_state.transfer_rows[idx]["from_location"] = from_loc
-
-    with cols[2]:
-        selection = st.selectbox(
-            "Item", options=[""] + all_parts,
-            index=(all_parts.index(row["item_selected"]) + 1) if row["item_selected"] in all_parts else 0,
-            key=f"item_{idx}",
-        )
-        st.session_state.transfer_rows[idx]["item_selected"] = selection
-
-    with cols[3]:
-        quantity = st.number_input(
-            "Qty", min_value=0, value=row["quantity"], key=f"qty_{idx}"
-        )
-        st.session_state.transfer_rows[idx]["quantity"] = quantity
-
-    with cols[4]:
-        note = st.text_input(
-            "Notes", value=row.get("notes", ""), key=f"notes_{idx}"
-        )
-        st.session_state.transfer_rows[idx]["notes"] = note
-
-    if st.button(f"❌ Delete Transfer {idx+1}", key=f"delete_{idx}"):
-        rows_to_delete.append(idx)
-
-# Handle deletion
-for idx in sorted(rows_to_delete, reverse=True):
-    delete_row(idx)
+# One grid widget for all rows instead of five widgets per row. transfer_rows is
+# only the editor's starting data and changes on submit; edits are kept in the
+# editor's own state, and a new key resets the grid.
+edited_df = st.data_editor(
+    pd.DataFrame(st.session_state.transfer_rows, columns=transfer_row_columns),
+    column_config={
+        "to_location": st.column_config.SelectboxColumn(
+            "To", options=locations_list, default=default_location, required=True
+        ),
+        "from_location": st.column_config.SelectboxColumn(
+            "From", options=locations_list, default=default_location, required=True
+        ),
+        "item_selected": st.column_config.SelectboxColumn(
+            "Item", options=all_parts, width="large"
+        ),
+        "quantity": st.column_config.NumberColumn(
+            "Qty", min_value=0, step=1, default=0
+        ),
+        "notes": st.column_config.TextColumn("Notes", default=""),
+    },
+    column_order=["to_location", "from_location", "item_selected", "quantity", "notes"],
+    num_rows="dynamic",
+    hide_index=True,
+    width="stretch",
+    key=f"transfers_{st.session_state.editor_version}",
+)
+too_many_rows = len(edited_df) > max_transfer_rows
+if too_many_rows:
+    st.warning(f"⚠️ Too many transfer rows. Delete some to get back to {max_transfer_rows} before submitting.")
+# Never fill in a location the grid doesn't show; make the user pick it
+missing_locations = edited_df[["from_location", "to_location"]].isna().any(axis=None)
+if missing_locations:
+    st.warning("⚠️ Every transfer needs a From and To location before submitting.")
+edited_rows = (
+    edited_df.fillna({"item_selected": "", "quantity": 0, "notes": ""})
+    .astype({"quantity": int})
+    .to_dict("records")
+)
 
 st.markdown("---")
 
-# Check if last row has an item selected, then auto add new blank row
-if last_row_has_item_selected():
-    last_row = st.session_state.transfer_rows[-1]
-    add_row(prev_from=last_row["from_location"], prev_to=last_row["to_location"])
-
 # Submit button
-if st.button("✅ Submit Transfers"):
-    save_transfers(st.session_state.transfer_rows)
+if st.button("✅ Submit Transfers", disabled=too_many_rows or missing_locations) and save_transfers(edited_rows):
     st.session_state.transfer_rows = []
     add_row()
-    st.success("Transfers submitted successfully!")
+    # Drop the old grid's edit state rather than leaving it in the session
+    st.session_state.pop(f"transfers_{st.session_state.editor_version}", None)
+    st.session_state.editor_version += 1
+    # Rerun so the cleared grid shows straight away; the message survives via session state
+    st.session_state.submit_message = "Transfers submitted successfully!"
+    st.rerun()
+
+if "submit_message" in st.session_state:
+    st.success(st.session_state.pop("submit_message"))
 
 # ---------- Display Past Transfers ----------
 if os.path.exists(transfers_file):
     st.markdown("### Last 10 Transfers:")
-    df = pd.read_excel(transfers_file)
-    st.dataframe(df.tail(10), use_container_width=True)
+    # Key on mtime_ns and size; two quick submits can share a coarse mtime
+    stat = os.stat(transfers_file)
+    df = load_recent_transfers((stat.st_mtime_ns, stat.st_size))
+    st.dataframe(df, width="stretch")
 else:
     st.info("No transfers have been submitted yet.")